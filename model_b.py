@@ -1,8 +1,10 @@
 import os
+import json
 import math
 import warnings
 import logging
 from itertools import chain
+from collections import OrderedDict
 import torch
 import torch.nn.functional as F
 from torch import nn, Tensor
@@ -10,10 +12,13 @@ from tensordict import TensorDict
 from typing import Optional, Dict, Union, List, Tuple
 import numpy as np
 from functools import partial
+from dataclasses import replace
 from datetime import datetime
 from tensordict import TensorDict
 from transformers.trainer_seq2seq import Seq2SeqTrainer
 from transformers.training_args_seq2seq import Seq2SeqTrainingArguments
+from torch.utils.data import DataLoader
+from datasets import Dataset
 from echoutils import *
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
@@ -35,6 +40,8 @@ class Dimensions:
     tokenizer: str
 
 class rotary(nn.Module):
+
+    real = False
     def __init__(self, dims, head, max_ctx=1500, radii=False, debug: List[str] = [], use_pbias=False, axial=False, spec_shape=None):
 
         super(rotary, self).__init__()
@@ -53,6 +60,12 @@ class rotary(nn.Module):
         self.theta = nn.Parameter(theta, requires_grad=True)    
         self.theta_values = []
 
+        self.max_cached = 8
+        self.max_table = 16384
+        self._freqs = OrderedDict()
+        self._theta_version = None
+        self.theta.register_hook(self._clear_freqs)
+
         if axial and spec_shape is not None:
             time_frames, freq_bins = spec_shape
             self.time_frames = time_frames
@@ -75,6 +88,43 @@ class rotary(nn.Module):
                                     f0_norm.unsqueeze(1)))
         return f0_sim.unsqueeze(0).unsqueeze(0)
 
+    def _clear_freqs(self, grad=None):
+        self._freqs.clear()
+        return grad
+
+    def cached_freqs(self, ctx, offset=0):
+        if offset + ctx > self.max_table:
+            t = torch.arange(offset, offset + ctx, device=self.theta.device, dtype=dtype)
+            freqs = t[:, None] * self.theta_freqs(self.theta)
+            return torch.polar(torch.ones_like(freqs), freqs)
+        version = (self.theta._version, self.theta.data_ptr())
+        if version != self._theta_version:
+            self._freqs.clear()
+            self._theta_version = version
+        n = max(64, 1 << (offset + ctx - 1).bit_length())
+        key = (n, self.theta.device, torch.is_grad_enabled())
+        if key in self._freqs:
+            self._freqs.move_to_end(key)
+        else:
+            t = torch.arange(n, device=self.theta.device, dtype=dtype)
+            freqs = t[:, None] * self.theta_freqs(self.theta)
+            self._freqs[key] = torch.polar(torch.ones_like(freqs), freqs)
+            if len(self._freqs) > self.max_cached:
+                self._freqs.popitem(last=False)
+        return self._freqs[key][offset:offset + ctx]
+
+    @staticmethod
+    def pitch_features(f0, rank=16):
+        # cosine-series features of exp(-|a - b|) over the utterance's f0 range: phi(a) @ phi(b).T ~ pitch_bias
+        f0 = f0.float().flatten(1) if f0.dim() > 1 else f0.float().unsqueeze(0)
+        f0_norm = (f0 - f0.mean(-1, keepdim=True)) / (f0.std(-1, keepdim=True) + 1e-8)
+        period = (f0_norm.amax(-1, keepdim=True) - f0_norm.amin(-1, keepdim=True)).clamp(min=1e-4)
+        m = torch.arange(rank, device=f0.device, dtype=f0_norm.dtype)
+        coef = 2 * (1 - (1 - 2 * (m % 2)) * torch.exp(-period)) / (period * (1 + (math.pi * m / period) ** 2))
+        coef[:, 0] = coef[:, 0] / 2
+        angle = f0_norm.unsqueeze(-1) * (math.pi * m / period).unsqueeze(1)
+        return torch.cat([angle.cos(), angle.sin()], dim=-1) * coef.sqrt().repeat(1, 2).unsqueeze(1)
+
     def theta_freqs(self, theta):
         if theta.dim() == 0:
             theta = theta.unsqueeze(0)
@@ -121,18 +171,23 @@ class rotary(nn.Module):
         freqs_cis_y = torch.polar(torch.ones_like(freqs_y), freqs_y)
         return torch.cat([freqs_cis_x, freqs_cis_y], dim=-1)
 
-    def forward(self, x=None, en=None, f=None, layer=None) -> Tensor:
+    def forward(self, x=None, en=None, f=None, layer=None, offset=0, positions=None) -> Tensor:
         ctx=x
+        if positions is not None:
+            return self.cached_freqs(int(positions.max()) + 1)[positions].unsqueeze(1)
         f0 = en.get("f0") if en is not None else None 
         f0t = en.get("f0t") if en is not None else None 
 
         f0 = self.check_f0(f0, f0t, ctx)
+        if f0 is None and not (self.axial and f == "spectrogram"):
+            self.counter += 1
+            return self.cached_freqs(ctx, offset).unsqueeze(0)
         if f0 is not None:
             theta = f0 + self.theta  
         else:
             theta = self.theta 
         freqs = self.theta_freqs(theta)
-        t = torch.arange(ctx, device=device, dtype=dtype)
+        t = torch.arange(offset, offset + ctx, device=device, dtype=dtype)
         freqs = t[:, None] * freqs
         freqs, radius = self._apply_radii(freqs, f0, ctx)
 
@@ -159,9 +214,33 @@ class rotary(nn.Module):
         x1 = x1.view(orig_shape)
         return torch.cat([x1.type_as(x), x2], dim=-1)
 
+    @staticmethod
+    def apply_rotary_real(x, cos, sin):
+        n = cos.shape[-1] * 2
+        cos, sin = cos.to(x.dtype), sin.to(x.dtype)
+        xe, xo = x[..., 0:n:2], x[..., 1:n:2]
+        if torch.is_grad_enabled() and (x.requires_grad or cos.requires_grad):
+            x1 = torch.stack([xe * cos - xo * sin, xe * sin + xo * cos], dim=-1).flatten(-2)
+            return x1 if n == x.shape[-1] else torch.cat([x1, x[..., n:]], dim=-1)
+        out = torch.empty_like(x)
+        torch.mul(x[..., :n], cos.repeat_interleave(2, dim=-1), out=out[..., :n])
+        pairs = out[..., :n].unflatten(-1, (-1, 2))
+        pairs[..., 0].addcmul_(xo, sin, value=-1)
+        pairs[..., 1].addcmul_(xe, sin)
+        if n != x.shape[-1]:
+            out[..., n:] = x[..., n:]
+        return out
+
+    def rotate(self, x, freqs):
+        if self.real:
+            return self.apply_rotary_real(x, freqs.real, freqs.imag)
+        return self.apply_rotary(x, freqs)
+
 class MultiheadA(nn.Module):
 
     rbf = False
+    sdpa = False
+    pbias_rank = 0
     def __init__(self, dims: int, head: int, rotary_emb: bool = True, 
                  zero_val: float = 1e-7, minz: float = 1e-8, maxz: float = 1e-6, debug: List[str] = [], optim_attn=False, use_pbias=False):
         super(MultiheadA, self).__init__()
@@ -195,61 +274,152 @@ class MultiheadA(nn.Module):
                 )
         else:
             self.rope = None         
-    def forward(self, x: Tensor, xa = None, mask = None, en= None, layer = None, f=None) -> tuple:
+    def cross_kv(self, xa: Tensor, en=None, f=None, layer=None, offset=0) -> tuple:
+        xa = xa.to(device, dtype)
+        k = self.k(xa)
+        v = self.v(xa)
+        k = k.view(*k.shape[:2], self.head, -1).permute(0, 2, 1, 3)
+        v = v.view(*v.shape[:2], self.head, -1).permute(0, 2, 1, 3)
+        if self.rotary_emb:
+            k = self.rope.rotate(k, (self.rope(x=k.shape[2], en=en, f=f, layer=layer, offset=offset)))
+        return k, v
+
+    def forward(self, x: Tensor, xa = None, mask = None, en= None, layer = None, f=None, kv_cache=None, input_pos=None, kv=None, key_mask=None, positions=None) -> tuple:
 
         x = x.to(device, dtype)
         if xa is not None:
             xa = xa.to(device, dtype)
         scale = (self.dims // self.head) ** -0.25
         
-        z = default(xa, x).to(device, dtype)
         q = self.q(x)
-        k = self.k(z)
-        v = self.v(z)
-
-        if self.rotary_emb:   
-            q = q.view(*q.shape[:2], self.head, -1).permute(0, 2, 1, 3)
+        q = q.view(*q.shape[:2], self.head, -1).permute(0, 2, 1, 3)
+        offset = int(input_pos[0]) if input_pos is not None else 0
+        if kv is None:
+            z = default(xa, x).to(device, dtype)
+            k = self.k(z)
+            v = self.v(z)
             k = k.view(*k.shape[:2], self.head, -1).permute(0, 2, 1, 3)
             v = v.view(*v.shape[:2], self.head, -1).permute(0, 2, 1, 3)
-            q2 = q.shape[2]
-            k2 = k.shape[2]
-
-            q = self.rope.apply_rotary(q, (self.rope(x=q2, en=en, f=f, layer=layer)))
-            k = self.rope.apply_rotary(k, (self.rope(x=k2, en=en, f=f, layer=layer)))
         else:
-            q = q.view(*q.shape[:2], self.head, -1).permute(0, 2, 1, 3)
-            k = k.view(*k.shape[:2], self.head, -1).permute(0, 2, 1, 3)
-            v = v.view(*v.shape[:2], self.head, -1).permute(0, 2, 1, 3)
+            k, v = kv
+        q2 = q.shape[2]
+        k2 = k.shape[2]
+
+        if self.rotary_emb:   
+            freqs = self.rope(x=q2, en=en, f=f, layer=layer, offset=offset, positions=positions)
+            q = self.rope.rotate(q, freqs)
+            if kv is None:
+                if k2 != q2 or (xa is not None and offset != 0):
+                    freqs = self.rope(x=k2, en=en, f=f, layer=layer, offset=offset if xa is None else 0)
+                k = self.rope.rotate(k, freqs)
+
+        group = q.shape[0] // k.shape[0]
+        if group > 1:
+            q = q.view(k.shape[0], group, *q.shape[1:]).transpose(1, 2).flatten(2, 3)
+
+        if kv_cache is not None and xa is None:
+            kv_cache.update(input_pos, k.to(kv_cache.k_cache.dtype), v.to(kv_cache.v_cache.dtype))
+            k, v = kv_cache.get()
+            k, v = k.to(q.dtype), v.to(q.dtype)
+            k2 = k.shape[2]
         
+        if self.sdpa and not self.rbf and "weights" not in self.debug:
+            return self._sdpa(q, k, v, q2, k2, group, scale, mask=mask, en=en, offset=offset, cross=xa is not None, key_mask=key_mask, positions=positions, cached=kv_cache is not None)
+
         qk = (q * scale) @ (k * scale).transpose(-1, -2)
 
         if self.rbf:
             qk = self.rbf_scores(q * scale, k * scale, rbf_sigma=1.0, rbf_ratio=0.3)
-        if self.use_pbias:
+        if self.use_pbias and self.pbias_rank:
+            phi = self.pitch_terms(en, k.shape[0], q2, k2, group, offset, xa is not None or kv_cache is not None, positions)
+            if phi is not None:
+                qk = qk + (phi[0] @ phi[1].transpose(-1, -2)).unsqueeze(1)
+        elif self.use_pbias:
             pbias = self.rope.pitch_bias(f0 = en.get("f0", None) if en is not None else None) 
             if pbias is not None:
                 qk = qk + pbias[:,:,:q2,:q2]
 
-        token_ids = k[:, :, :, 0]
-        zscale = torch.ones_like(token_ids)
-        fzero = torch.clamp(F.softplus(self.fzero), self.minz, self.maxz)
-        zscale[token_ids.float() == self.pad_token] = fzero
-        
         if mask is not None:
-            if mask.dim() == 4:
-                mask = mask[0, 0]
-            mask = mask[:q2, :k2] if xa is not None else mask[:q2, :q2]
-            qk = qk + mask * zscale.unsqueeze(-2).expand(qk.shape)
+            qk = qk + self.slice_mask(mask, q2, k2, offset, xa is not None, positions)
 
-        qk = qk * zscale.unsqueeze(-2)
+        if key_mask is not None:
+            qk = qk.masked_fill(~self.expand_key_mask(key_mask, k2), torch.finfo(qk.dtype).min)
         w = F.softmax(qk, dim=-1).to(q.dtype)
-        wv = (w @ v).permute(0, 2, 1, 3).flatten(start_dim=2)
+        wv = w @ v
+        if group > 1:
+            wv = wv.view(wv.shape[0], self.head, group, q2, -1).transpose(1, 2).flatten(0, 1)
+        wv = wv.permute(0, 2, 1, 3).flatten(start_dim=2)
 
         if "multihead" in self.debug and self.counter % 100 == 0:
             print(f"MHA: q={q.shape}, k={k.shape}, v={v.shape} - {qk.shape}, wv shape: {wv.shape}")
         self.counter += 1        
         return self.o(wv), qk
 
+    @staticmethod
+    def slice_mask(mask, q2, k2, offset=0, cross=False, positions=None):
+        if mask.dim() == 4:
+            mask = mask[0, 0]
+        if positions is not None and not cross:
+            return mask[positions][..., :k2].unsqueeze(1)
+        return mask[:q2, :k2] if cross else mask[offset:offset + q2, :k2]
+
+    @staticmethod
+    def expand_key_mask(key_mask, k2):
+        return key_mask[:, None, None, :k2] if key_mask.dim() == 2 else key_mask[:, None, :, :k2]
+
+    def pitch_factors(self, en):
+        if en is None or en.get("f0") is None:
+            return None
+        key = f"f0_phi{self.pbias_rank}"
+        if key not in en:
+            en[key] = rotary.pitch_features(en["f0"], self.pbias_rank)
+        return en[key]
+
+    def pitch_terms(self, en, batch, q2, k2, group=1, offset=0, keys_from_zero=False, positions=None):
+        # phi rows at the real query/key positions; cross memory and kv caches hold keys 0..k2,
+        # and queries of a beam-expanded batch are grouped per memory row
+        phi = self.pitch_factors(en)
+        if phi is None:
+            return None
+        phi = phi.expand(batch, -1, -1) if phi.shape[0] != batch else phi
+        if positions is not None:
+            qpos = positions.reshape(batch, group * q2)
+        else:
+            qpos = torch.arange(offset, offset + q2, device=phi.device).repeat(group)
+        kpos = positions.reshape(batch, k2) if positions is not None and not keys_from_zero else torch.arange(k2, device=phi.device)
+        return self.gather_positions(phi, qpos), self.gather_positions(phi, kpos)
+
+    @staticmethod
+    def gather_positions(phi, pos):
+        if pos.dim() == 1:
+            return phi[:, pos]
+        return phi.gather(1, pos.unsqueeze(-1).expand(-1, -1, phi.shape[-1]))
+
+    def _sdpa(self, q, k, v, q2, k2, group, scale, mask=None, en=None, offset=0, cross=False, key_mask=None, positions=None, cached=False):
+        phi = self.pitch_terms(en, k.shape[0], q2, k2, group, offset, cross or cached, positions) if self.use_pbias and self.pbias_rank else None
+        if phi is not None:
+            q = torch.cat([q, (phi[0][:, None] / scale ** 2).expand(-1, self.head, -1, -1).to(q.dtype)], dim=-1)
+            k = torch.cat([k, phi[1][:, None].expand(-1, self.head, -1, -1).to(k.dtype)], dim=-1)
+
+        bias = None
+        if self.use_pbias and not self.pbias_rank:
+            pbias = self.rope.pitch_bias(f0 = en.get("f0", None) if en is not None else None)
+            if pbias is not None:
+                bias = pbias[:,:,:q2,:q2]
+        if mask is not None:
+            mask = self.slice_mask(mask, q2, k2, offset, cross, positions).to(q.dtype)
+            bias = mask if bias is None else bias + mask
+        if key_mask is not None:
+            bias = torch.zeros((), dtype=q.dtype, device=q.device) if bias is None else bias
+            bias = torch.where(self.expand_key_mask(key_mask, k2), bias, torch.finfo(q.dtype).min)
+
+        wv = F.scaled_dot_product_attention(q, k, v, attn_mask=bias, scale=scale ** 2)
+        if group > 1:
+            wv = wv.view(wv.shape[0], self.head, group, q2, -1).transpose(1, 2).flatten(0, 1)
+        wv = wv.permute(0, 2, 1, 3).flatten(start_dim=2)
+        self.counter += 1
+        return self.o(wv), None
+
     @staticmethod
     def split(X: Tensor) -> (Tensor, Tensor):
         half_dim = X.shape[-1] // 2
@@ -259,20 +429,25 @@ class t_gate(nn.Module):
     def __init__(self, dims, num_types=4, enabled=True):
         super().__init__()
         self.enabled = enabled
-        self.gate_projections = nn.ModuleList([
-            nn.Sequential(Linear(dims, 1), nn.Sigmoid())
-            for _ in range(num_types)])
-        self.type_classifier = nn.Sequential(
-            Linear(dims, num_types),
-            nn.Softmax(dim=-1))
+        self.num_types = num_types
+        # rows [:num_types] are the per-type gate logits, rows [num_types:] the type classifier
+        self.proj = Linear(dims, 2 * num_types)
+
     def forward(self, x):
         if not self.enabled:
             return None
-        type_probs = self.type_classifier(x)
-        gates = torch.stack([gate(x) for gate in self.gate_projections], dim=-1)
-        comb_gate = torch.sum(gates * type_probs.unsqueeze(2), dim=-1)
+        gates, types = self.proj(x).chunk(2, dim=-1)
+        comb_gate = torch.sum(torch.sigmoid(gates) * torch.softmax(types, dim=-1), dim=-1, keepdim=True)
         return comb_gate
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # checkpoints from before the fused projection: num_types Linear(dims, 1) gates + Linear(dims, num_types) classifier
+        old = [f"{prefix}gate_projections.{i}.0.linear." for i in range(self.num_types)] + [f"{prefix}type_classifier.0.linear."]
+        for name in ("weight", "bias"):
+            if all(o + name in state_dict for o in old):
+                state_dict[f"{prefix}proj.linear.{name}"] = torch.cat([state_dict.pop(o + name) for o in old])
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
 class m_gate(nn.Module):
     def __init__(self, dims, mem_size=64, enabled=True):
         super().__init__()
@@ -369,10 +544,10 @@ class Residual(nn.Module):
         self.lnb = RMSNorm(dims)
         self.lnc = RMSNorm(dims)
 
-    def forward(self, x, xa=None, mask=None, en=None, layer=None, f=None) -> Tensor:
+    def forward(self, x, xa=None, mask=None, en=None, layer=None, f=None, kv_cache=None, input_pos=None, kv=None, key_mask=None, positions=None) -> Tensor:
  
         b = torch.sigmoid(self.blend)
-        ax = x + self.attn(self.lna(x), xa=xa, mask=mask, en=en, layer=layer, f=f)[0]
+        ax = x + self.attn(self.lna(x), xa=xa, mask=mask, en=en, layer=layer, f=f, kv_cache=kv_cache, input_pos=input_pos, kv=kv, key_mask=key_mask, positions=positions)[0]
         bx = b * ax + (1 - b) * x
         cx = self.lnb(bx)
         dx = self.mlp(cx)
@@ -458,6 +633,18 @@ class PositionalEncoding(nn.Module):
         x = x + pe
         return x
 
+def masked_conv(encoder, x, lengths=None):
+    if lengths is None:
+        return encoder(x)
+    lengths = lengths.to(x.device)
+    for m in encoder:
+        x = m(x)
+        if isinstance(m, nn.Conv1d):
+            span = m.dilation[0] * (m.kernel_size[0] - 1) + 1
+            lengths = (lengths + 2 * m.padding[0] - span) // m.stride[0] + 1
+        x = x * (torch.arange(x.shape[-1], device=x.device) < lengths[:, None]).unsqueeze(1).to(x.dtype)
+    return x
+
 class FEncoder(nn.Module):
     def __init__(self, mels, dims, head, layer, kernel_size, act, stride=1, use_rope=False, spec_shape=None, debug=[]):
         super().__init__()
@@ -492,24 +679,24 @@ class FEncoder(nn.Module):
                 self.rope = rotary(dims=dims, head=head, radii=False, debug=[], use_pbias=False, axial=False, spec_shape=spec_shape)
         else:
             self.rope = None
-            self.positional = lambda length, dims, max_tscale: sinusoids(length, dims, max_tscale)
+            self.positional = lambda length, dims, max_tscale, offset=0: sinusoids(length, dims, max_tscale, offset)
         self.norm = RMSNorm(dims)
 
-    def apply_rope_to_features(self, x, en=None, f=None, layer="audio"):
+    def apply_rope_to_features(self, x, en=None, f=None, layer="audio", offset=0):
         batch, ctx, dims = x.shape
         x = x.view(batch, ctx, self.head, self.head_dim).permute(0, 2, 1, 3)
-        freqs = self.rope(ctx, en=en, f=f, layer=layer)
-        x = self.rope.apply_rotary(x, freqs)
+        freqs = self.rope(ctx, en=en, f=f, layer=layer, offset=offset)
+        x = self.rope.rotate(x, freqs)
         x = x.permute(0, 2, 1, 3).contiguous().view(batch, ctx, dims)
 
         return x
 
-    def forward(self, x: Tensor, en=None, f=None, layer = None):
-        x = self.encoder(x).permute(0, 2, 1)
+    def forward(self, x: Tensor, en=None, f=None, layer = None, lengths=None, offset=0):
+        x = masked_conv(self.encoder, x, lengths).permute(0, 2, 1)
         if self.use_rope:
-            x = self.apply_rope_to_features(x, en=en, f=f, layer=layer)
+            x = self.apply_rope_to_features(x, en=en, f=f, layer=layer, offset=offset)
         else:
-            x = x + self.positional(x.shape[1], x.shape[-1], 10000).to(device, dtype)
+            x = x + self.positional(x.shape[1], x.shape[-1], 10000, offset).to(device, dtype)
 
         if self.mlp is not None:
             x = self.mlp(x)
@@ -555,12 +742,12 @@ class WEncoder(nn.Module):
         batch, ctx, dims = x.shape
         x = x.view(batch, ctx, self.head, self.head_dim).permute(0, 2, 1, 3)
         freqs = self.rope(ctx, en=en, f=f, layer=layer)
-        x = self.rope.apply_rotary(x, freqs)
+        x = self.rope.rotate(x, freqs)
         x = x.permute(0, 2, 1, 3).contiguous().view(batch, ctx, dims)
         return x
         
-    def forward(self, x: Tensor, en= None, f=None, layer = None):
-        x = self.encoder(x).permute(0, 2, 1)
+    def forward(self, x: Tensor, en= None, f=None, layer = None, lengths=None):
+        x = masked_conv(self.encoder, x, lengths).permute(0, 2, 1)
         if self.target_length and x.shape[1] != self.target_length:
             x = F.adaptive_avg_pool1d(x.transpose(1, 2), self.target_length).transpose(1, 2)
         if self.use_rope:
@@ -601,31 +788,168 @@ class PEncoder(nn.Module):
         batch, ctx, dims = x.shape
         x = x.view(batch, ctx, self.head, self.head_dim).permute(0, 2, 1, 3)
         freqs = self.rope(ctx, en=en, f=f, layer=layer)
-        x = self.rope.apply_rotary(x, freqs)
+        x = self.rope.rotate(x, freqs)
         x = x.permute(0, 2, 1, 3).contiguous().view(batch, ctx, dims)
         return x
             
-    def forward(self, x: Tensor, en=None, f="pitch", layer="PEncoder"):
+    def scaled_positional(self, x, lengths=None):
+        # with lengths, each utterance's timescale comes from the mean over its own valid frames;
+        # without them it stays one batch-wide mean
+        batch, ctx, dims = x.shape
+        if lengths is None:
+            return self.positional(ctx, dims, x.mean() * 300).to(device, dtype)
+        valid = (torch.arange(ctx, device=x.device) < lengths.to(x.device)[:, None]).unsqueeze(-1)
+        mean = (x * valid).sum((1, 2)) / (valid.sum((1, 2)) * dims)
+        return self.positional(ctx, dims, mean.view(batch, 1) * 300).to(device, dtype)
+
+    def forward(self, x: Tensor, en=None, f="pitch", layer="PEncoder", lengths=None):
         raw_pitch = x.clone()
         if x.dim() == 2:
             x = x.unsqueeze(0)
-        x = self.encoder(x).permute(0, 2, 1)
+        x = masked_conv(self.encoder, x, lengths).permute(0, 2, 1)
         if self.use_rope:
             enc_dict = en if en is not None else {}
             enc_dict = dict(enc_dict)  
             enc_dict["f0"] = raw_pitch  
-            max_tscale = x.mean()*300
-            x = x + self.positional(x.shape[1], x.shape[-1], max_tscale).to(device, dtype)
+            x = x + self.scaled_positional(x, lengths)
             x = self.rope_to_feature(x, en=enc_dict, f=f, layer=layer)
         else:
-            max_tscale = x.mean()*300
-            x = x + self.positional(x.shape[1], x.shape[-1], max_tscale).to(device, dtype)
+            x = x + self.scaled_positional(x, lengths)
         x = nn.functional.dropout(x, p=self.dropout, training=self.training)
         x = self.norm(x)
         print(f"X: {x.shape} {f}") if "PEncoder" in self.debug else None
         return x
 
+@dataclass
+class EncoderMemory:
+    xa: Tensor
+    kv: List[Tuple[Tensor, Tensor]]
+    en: Dict[str, Tensor]
+    feature: str
+    group: int = 1
+    mask: Optional[Tensor] = None
+
+    @property
+    def batch_size(self):
+        return self.xa.shape[0] * self.group
+
+    def expand(self, n):
+        return replace(self, group=self.group * n)
+
+    def select(self, rows):
+        b = self.xa.shape[0]
+        en = {k: v[rows] if isinstance(v, Tensor) and v.shape[0] == b else v for k, v in self.en.items()}
+        xa, kv, mask = self.xa[rows], [(k[rows], v[rows]) for k, v in self.kv], None
+        if self.mask is not None:
+            mask = self.mask[rows]
+            n = int(mask.sum(-1).max())
+            if n < mask.shape[1]:
+                xa, kv, mask = xa[:, :n], [(k[:, :, :n], v[:, :, :n]) for k, v in kv], mask[:, :n]
+        return replace(self, xa=xa, kv=kv, en=en, mask=mask)
+
+    @staticmethod
+    def cat(memories):
+        if len(memories) == 1:
+            return memories[0]
+        xa = torch.cat([m.xa for m in memories], dim=1)
+        kv = [(torch.cat([k for k, _ in layer], dim=2), torch.cat([v for _, v in layer], dim=2))
+              for layer in zip(*[m.kv for m in memories])]
+        mask = None
+        if any(m.mask is not None for m in memories):
+            mask = torch.cat([default(m.mask, torch.ones(m.xa.shape[:2], dtype=torch.bool, device=m.xa.device)) for m in memories], dim=1)
+        return EncoderMemory(xa=xa, kv=kv, en=memories[-1].en, feature=memories[-1].feature, group=memories[-1].group, mask=mask)
+
+class StreamingEncoder:
+    def __init__(self, bridge, feature="spectrogram", chunk=32, left=256, en=None):
+        blocks = bridge.blockA[feature] if feature in bridge.blockA else None
+        if blocks is None or not isinstance(blocks[0], FEncoder):
+            raise ValueError(f"streaming needs a stride-1 FEncoder branch, got {feature}")
+        self.bridge = bridge
+        self.feature = feature
+        self.front = blocks[0]
+        self.blocks = list(blocks[1:])
+        self.chunk = chunk
+        self.en = en if en is not None else {}
+        self.halo = sum(m.padding[0] for m in self.front.encoder.modules() if isinstance(m, nn.Conv1d))
+        self.cache = [WindowKVCache(left + chunk, dtype=dtype, device=device) for _ in self.blocks]
+        self.buffer = None
+        self.start = 0
+        self.emitted = 0
+
+    @torch.no_grad()
+    def push(self, frames, final=False):
+        if frames is not None and frames.shape[-1]:
+            frames = frames.to(device, dtype)
+            self.buffer = frames if self.buffer is None else torch.cat([self.buffer, frames], dim=-1)
+        out = []
+        received = self.start + (self.buffer.shape[-1] if self.buffer is not None else 0)
+        while True:
+            end = self.emitted + self.chunk
+            if final:
+                end = min(end, received)
+            elif end + self.halo > received:
+                break
+            if end <= self.emitted:
+                break
+            out.append(self.step(self.emitted, end, received))
+        return out
+
+    def step(self, s, e, received):
+        lo, hi = max(0, s - self.halo), min(e + self.halo, received)
+        x = self.buffer[..., lo - self.start:hi - self.start]
+        y = self.front(x, en=self.en, f=self.feature, layer="enc", offset=lo)[:, s - lo:e - lo]
+        pos = torch.arange(s, e, device=y.device)
+        for block, cache in zip(self.blocks, self.cache):
+            y = block(x=y, en=self.en, f=self.feature, layer="enc", kv_cache=cache, input_pos=pos)
+        kv = [block.attn.cross_kv(y, en=self.en, f=self.feature, layer="cross", offset=s) for block in self.bridge.blockB]
+        self.emitted = e
+        keep = max(0, e - self.halo) - self.start
+        self.buffer, self.start = self.buffer[..., keep:], self.start + keep
+        return EncoderMemory(xa=y, kv=kv, en=self.en, feature=self.feature)
+
+class ChunkedCrossEntropy(torch.autograd.Function):
+    # tied output projection + cross-entropy over `chunk` rows at a time; logits are recomputed in backward, never stored
+    @staticmethod
+    def forward(ctx, x, weight, labels, chunk, ignore_index=0, upcast=True):
+        compute = torch.float32 if upcast else x.dtype
+        w = weight.to(compute)
+        valid = labels != ignore_index
+        target = labels.masked_fill(~valid, 0)
+        lse = torch.empty(x.shape[0], dtype=torch.float32, device=x.device)
+        total = torch.zeros((), dtype=torch.float32, device=x.device)
+        for s in range(0, x.shape[0], chunk):
+            logits = (x[s:s + chunk].to(compute) @ w.T).float()
+            lse[s:s + chunk] = logits.logsumexp(dim=-1)
+            picked = logits.gather(-1, target[s:s + chunk, None]).squeeze(-1)
+            total += ((lse[s:s + chunk] - picked) * valid[s:s + chunk]).sum()
+        count = valid.sum().clamp(min=1)
+        ctx.save_for_backward(x, weight, target, valid, lse, count)
+        ctx.chunk, ctx.compute = chunk, compute
+        return total / count
+
+    @staticmethod
+    def backward(ctx, grad):
+        x, weight, target, valid, lse, count = ctx.saved_tensors
+        w = weight.to(ctx.compute)
+        scale = (grad / count) * valid
+        grad_x = torch.empty_like(x) if ctx.needs_input_grad[0] else None
+        grad_w = torch.zeros(weight.shape, dtype=torch.float32, device=weight.device) if ctx.needs_input_grad[1] else None
+        for s in range(0, x.shape[0], ctx.chunk):
+            xc = x[s:s + ctx.chunk].to(ctx.compute)
+            g = ((xc @ w.T).float() - lse[s:s + ctx.chunk, None]).exp_()
+            g[torch.arange(g.shape[0], device=g.device), target[s:s + ctx.chunk]] -= 1
+            g = (g * scale[s:s + ctx.chunk, None]).to(ctx.compute)
+            if grad_x is not None:
+                grad_x[s:s + ctx.chunk] = g @ w
+            if grad_w is not None:
+                grad_w += (g.T @ xc).float()
+        return grad_x, grad_w.to(weight.dtype) if grad_w is not None else None, None, None, None, None
+
 class theBridge(nn.Module):
+
+    pack = False
+    loss_chunk = 0
+    upcast = True
     def __init__(self, vocab: int, mels: int, ctx: int, dims: int, head: int, layer: int, 
                 debug: List[str], features: List[str], act: str = "gelu"): 
         super(theBridge, self).__init__()
@@ -684,17 +1008,78 @@ class theBridge(nn.Module):
             Residual(ctx=ctx, dims=dims, head=head, act=act_fn, tgate=tgate, mgate=mgate, cgate=cgate, debug=debug, features=features)
             for _ in range(layer)])
 
-        mask = torch.tril(torch.ones(ctx, ctx), diagonal=0) 
+        mask = torch.full((ctx, ctx), float("-inf")).triu_(1)
         self.register_buffer("mask", mask, persistent=False)
         self.norm = RMSNorm(dims)
 
-    def forward(self, x, xa, en, feature, sequential=False) -> Tensor:
-        x = self.token(x.long()) + self.positional[:x.shape[1]]    
+    def encoder(self, xa, en, feature, key_mask=None, lengths=None) -> Tensor:
         for block in chain(self.blockA[feature] or []):
-            xa = block(x=xa, en=en, f=feature, layer="enc")
-        for block in chain(self.blockB or []):                 
-            x = block(x=x, xa=None, mask=self.mask, en=en, f=feature, layer="dec")                
-            xc = block(x=x, xa=xa, mask=None, en=en, f=feature, layer="cross")
+            if isinstance(block, Residual):
+                xa = block(x=xa, en=en, f=feature, layer="enc", key_mask=key_mask)
+            else:
+                xa = block(x=xa, en=en, f=feature, layer="enc", lengths=lengths if key_mask is not None else None)
+        return xa
+
+    def feature_mask(self, feature, lengths, frames):
+        if lengths is None:
+            return None
+        lengths = lengths.to(device)
+        for m in self.blockA[feature][0].encoder.modules():
+            if isinstance(m, nn.Conv1d):
+                span = m.dilation[0] * (m.kernel_size[0] - 1) + 1
+                lengths = (lengths + 2 * m.padding[0] - span) // m.stride[0] + 1
+                frames = (frames + 2 * m.padding[0] - span) // m.stride[0] + 1
+        mask = torch.arange(frames, device=lengths.device) < lengths[:, None]
+        return None if bool(mask.all()) else mask
+
+    def packed_encoder(self, xa, en, feature, key_mask, lengths) -> Tensor:
+        blocks = list(self.blockA[feature])
+        xa = blocks[0](x=xa, en=en, f=feature, layer="enc", lengths=lengths)
+        B, T, D = xa.shape
+        n = key_mask.sum(-1).tolist()
+        fill, place = [], []
+        for b in sorted(range(B), key=lambda b: -n[b]):
+            r = next((r for r in range(len(fill)) if fill[r] + n[b] <= T), len(fill))
+            if r == len(fill):
+                fill.append(0)
+            place.append((b, r * T + fill[r]))
+            fill[r] += n[b]
+        src = torch.cat([b * T + torch.arange(n[b]) for b, _ in place]).to(xa.device)
+        dst = torch.cat([start + torch.arange(n[b]) for b, start in place]).to(xa.device)
+        seg = torch.full((len(fill) * T,), -1, dtype=torch.long, device=xa.device)
+        seg[dst] = torch.cat([torch.full((n[b],), b) for b, _ in place]).to(xa.device)
+        pos = torch.zeros(len(fill) * T, dtype=torch.long, device=xa.device)
+        pos[dst] = torch.cat([torch.arange(n[b]) for b, _ in place]).to(xa.device)
+        seg, pos = seg.view(-1, T), pos.view(-1, T)
+        packed_mask = (seg[:, :, None] == seg[:, None, :]) & (seg[:, None, :] >= 0)
+
+        x = xa.new_zeros(len(fill) * T, D)
+        x[dst] = xa.reshape(B * T, D)[src]
+        x = x.view(-1, T, D)
+        for block in blocks[1:]:
+            x = block(x=x, en=en, f=feature, layer="enc", key_mask=packed_mask, positions=pos)
+        out = xa.new_zeros(B * T, D)
+        out[src] = x.reshape(-1, D)[dst]
+        return out.view(B, T, D)
+
+    def memory(self, xa, en, feature, lengths=None) -> "EncoderMemory":
+        key_mask = self.feature_mask(feature, lengths, xa.shape[-1])
+        if self.pack and key_mask is not None and en.get("f0") is None and en.get("f0t") is None:
+            xa = self.packed_encoder(xa, en, feature, key_mask, lengths)
+        else:
+            xa = self.encoder(xa, en, feature, key_mask=key_mask, lengths=lengths)
+        kv = [block.attn.cross_kv(xa, en=en, f=feature, layer="cross") for block in self.blockB]
+        return EncoderMemory(xa=xa, kv=kv, en=en, feature=feature, mask=key_mask)
+
+    def decoder(self, x, memory, cache=None, key_mask=None, project=True) -> Tensor:
+        en, feature = memory.en, memory.feature
+        offset = cache[0].length if cache is not None else 0
+        input_pos = torch.arange(offset, offset + x.shape[1], device=x.device) if cache is not None else None
+        x = self.token(x.long()) + self.positional[offset:offset + x.shape[1]]
+        for i, block in enumerate(self.blockB or []):
+            kv_cache = cache[i] if cache is not None else None
+            x = block(x=x, xa=None, mask=self.mask, en=en, f=feature, layer="dec", kv_cache=kv_cache, input_pos=input_pos, key_mask=key_mask)
+            xc = block(x=x, xa=memory.xa, mask=None, en=en, f=feature, layer="cross", input_pos=input_pos, kv=memory.kv[i], key_mask=memory.mask)
             a = torch.sigmoid(self.blend)
             x = a * xc + (1 - a) * x            
 
@@ -704,14 +1089,65 @@ class theBridge(nn.Module):
         self.counter += 1
 
         x = self.norm(x)
-        x = x @ torch.transpose(self.token.weight.to(dtype), 0, 1).float()
+        return self.project(x) if project else x
+
+    def project(self, x) -> Tensor:
+        if self.upcast:
+            return x @ torch.transpose(self.token.weight.to(dtype), 0, 1).float()
+        return x @ torch.transpose(self.token.weight.to(x.dtype), 0, 1)
+
+    def project_topk(self, x, k, labels=None, ignore_index=0, chunk=None) -> tuple:
+        # top-k ids, their log-probs and the mean cross-entropy, with at most `chunk` rows of logits alive at once
+        chunk = chunk or self.loss_chunk or 1024
+        flat = x.reshape(-1, x.shape[-1])
+        ids = torch.empty(flat.shape[0], k, dtype=torch.long, device=x.device)
+        log_probs = torch.empty(flat.shape[0], k, dtype=torch.float32, device=x.device)
+        total = torch.zeros((), dtype=torch.float32, device=x.device)
+        target = labels.reshape(-1) if labels is not None else None
+        for s in range(0, flat.shape[0], chunk):
+            logits = self.project(flat[s:s + chunk]).float()
+            lse = logits.logsumexp(dim=-1, keepdim=True)
+            values, ids[s:s + chunk] = logits.topk(k, dim=-1)
+            log_probs[s:s + chunk] = values - lse
+            if target is not None:
+                t = target[s:s + chunk]
+                valid = t != ignore_index
+                picked = logits.gather(-1, t.masked_fill(~valid, 0)[:, None]).squeeze(-1)
+                total += ((lse.squeeze(-1) - picked) * valid).sum()
+        loss = total / (target != ignore_index).sum().clamp(min=1) if target is not None else None
+        return ids.view(*x.shape[:-1], k), log_probs.view(*x.shape[:-1], k), loss
+
+    def loss(self, x, labels, ignore_index=0) -> Tensor:
+        return ChunkedCrossEntropy.apply(x.reshape(-1, x.shape[-1]), self.token.weight, labels.reshape(-1),
+            self.loss_chunk, ignore_index, self.upcast)
+
+    def slot_decoder(self, x, memory, cache, positions) -> Tensor:
+        en, feature = memory.en, memory.feature
+        pos = positions.unsqueeze(-1)
+        key_mask = torch.arange(int(positions.max()) + 1, device=x.device) <= pos
+        x = self.token(x.long()) + self.positional[pos]
+        for i, block in enumerate(self.blockB or []):
+            x = block(x=x, xa=None, mask=self.mask, en=en, f=feature, layer="dec", kv_cache=cache[i], input_pos=pos, key_mask=key_mask, positions=pos)
+            xc = block(x=x, xa=memory.xa, mask=None, en=en, f=feature, layer="cross", kv=memory.kv[i], key_mask=memory.mask, positions=pos)
+            a = torch.sigmoid(self.blend)
+            x = a * xc + (1 - a) * x
+        x = self.norm(x)
+        return self.project(x)
 
-        return x
+    def init_cache(self, batch, max_len=None, dtype=None):
+        max_len = max_len or self.positional.shape[0]
+        return [KVCache(batch, max_len, block.head, block.head_dim, dtype=dtype or self.token.weight.dtype, device=self.token.weight.device)
+                for block in self.blockB]
+
+    def forward(self, x, xa, en, feature, sequential=False, cache=None) -> Tensor:
+        return self.decoder(x, self.memory(xa, en, feature), cache=cache)
    
 class Echo(nn.Module):
-    def __init__(self, param: Dimensions):
+
+    def __init__(self, param: Dimensions, topk: int = 0):
         super().__init__()
         self.param = param
+        self.topk = topk
         
         self.processor = theBridge(
             vocab=param.vocab,
@@ -736,6 +1172,7 @@ class Echo(nn.Module):
         harmonic: Optional[torch.Tensor]=None,
         aperiodic: Optional[torch.Tensor]=None,
         phase: Optional[torch.Tensor]=None,
+        lengths: Optional[Dict[str, torch.Tensor]]=None,
         ) -> Dict[str, Optional[torch.Tensor]]:
 
         en= TensorDict(batch_size=[1], device=self.device, dtype=self.dtype)
@@ -759,15 +1196,24 @@ class Echo(nn.Module):
             en["spectrogram"] = spectrogram
 
         x = input_ids
-        for f, xa in en.items():
-
-            logits = self.processor(x, xa, en, f)
+        key_mask = None
+        if lengths is not None and lengths.get("labels") is not None:
+            key_mask = torch.arange(x.shape[1], device=x.device) < lengths["labels"].to(x.device)[:, None]
+        memory = self.encode(en, lengths=lengths)
+        if labels is not None and self.training and self.processor.loss_chunk:
+            hidden = self.processor.decoder(x, memory, key_mask=key_mask, project=False)
+            return {"logits": None, "loss": self.processor.loss(hidden, labels)}
+        if self.topk and not self.training:
+            # eval: top-k ids and their log-probs instead of [batch, len, vocab] logits, projected a chunk at a time
+            hidden = self.processor.decoder(x, memory, key_mask=key_mask, project=False)
+            ids, log_probs, loss = self.processor.project_topk(hidden, self.topk, labels)
+            return {"loss": loss, "ids": ids, "log_probs": log_probs}
+        logits = self.decode(x, memory, key_mask=key_mask)
 
         loss = None
         if labels is not None:
             loss = F.cross_entropy(
                 logits.view(-1, logits.shape[-1]), labels.view(-1), ignore_index=0)
-        
         return {"logits": logits, "loss": loss} 
 
     @property
@@ -829,46 +1275,143 @@ class Echo(nn.Module):
             if count > 0:
                 print(f"{module_type}: {count}")
 
+    def encode(self, features, lengths=None) -> EncoderMemory:
+        en = {k: v for k, v in features.items() if v is not None}
+        lengths = lengths or {}
+        branches = [k for k in en if k in self.processor.blockA and self.processor.blockA[k] is not None]
+        return EncoderMemory.cat([self.processor.memory(en[f], en, f, lengths=lengths.get(f)) for f in branches])
+
+    def stream_encode(self, chunks, feature="spectrogram", chunk=32, left=256):
+        stream = StreamingEncoder(self.processor, feature=feature, chunk=chunk, left=left)
+        if isinstance(chunks, Tensor):
+            chunks = chunks.split(chunk, dim=-1)
+        for frames in chunks:
+            yield from stream.push(frames)
+        yield from stream.push(None, final=True)
+
+    def decode(self, input_ids, memory, cache=None, key_mask=None) -> Tensor:
+        return self.processor.decoder(input_ids, memory, cache=cache, key_mask=key_mask)
+
     def generate(self, input_ids=None, spectrogram=None, waveform=None, pitch=None, f0=None, 
-        envelope=None, phase=None, tokenizer=None, max_length=128, min_length=1, device=None, **kwargs):
+        envelope=None, phase=None, tokenizer=None, max_length=128, min_length=1, device=None, memory=None,
+        num_beams=1, length_penalty=1.0, lengths=None, **kwargs):
         if device is None:
             device = self.device
         pad_token_id = getattr(tokenizer, "pad_token_id", 0)
         bos_token_id = getattr(tokenizer, "bos_token_id", 1)
         eos_token_id = getattr(tokenizer, "eos_token_id", 2)
-        batch_size = 1
-        for x in [spectrogram, waveform, pitch, f0, envelope, phase]:
-            if x is not None:
-                batch_size = x.shape[0]
-                break
-        ids = torch.full((batch_size, 1), bos_token_id, dtype=torch.long, device=device)
-        feature = {}
-        if spectrogram is not None:
-            feature["spectrogram"] = spectrogram
-        if waveform is not None:
-            feature["waveform"] = waveform
-        if pitch is not None:
-            feature["pitch"] = pitch
-        if envelope is not None:
-            feature["envelope"] = envelope
-        if phase is not None:
-            feature["phase"] = phase
-        if f0 is not None:
-            feature["f0"] = f0
-        
-        for i in range(max_length - 1):
-            with torch.no_grad():
-                feature["input_ids"] = ids
-                logits = self.SpeechTransformer(feature)
-            next_token_logits = logits[:, -1, :]
-            if i < min_length:
-                next_token_logits[:, eos_token_id] = 0
-            next_tokens = torch.argmax(next_token_logits, dim=-1, keepdim=True)
-            ids = torch.cat([ids, next_tokens], dim=1)
-            if (next_tokens == eos_token_id).all() and i >= min_length:
-                break
+
+        with torch.no_grad():
+            if memory is None:
+                memory = self.encode({"f0": f0, "phase": phase, "pitch": pitch, "waveform": waveform,
+                    "envelope": envelope, "spectrogram": spectrogram}, lengths=lengths)
+            if num_beams > 1:
+                return self.beam_search(memory, num_beams=num_beams, max_length=max_length, min_length=min_length,
+                    length_penalty=length_penalty, pad_token_id=pad_token_id, bos_token_id=bos_token_id, eos_token_id=eos_token_id)
+            batch_size = memory.batch_size
+            ids = torch.full((batch_size, 1), bos_token_id, dtype=torch.long, device=device)
+            done = torch.zeros(batch_size, dtype=torch.bool, device=device)
+            cache = self.processor.init_cache(batch_size, max_length)
+            next_ids = ids
+            for i in range(max_length - 1):
+                logits = self.decode(next_ids, memory, cache=cache)
+                next_token_logits = logits[:, -1, :]
+                if i < min_length:
+                    next_token_logits[:, eos_token_id] = float("-inf")
+                next_tokens = torch.argmax(next_token_logits, dim=-1, keepdim=True)
+                next_tokens = next_tokens.masked_fill(done.unsqueeze(-1), pad_token_id)
+                ids = torch.cat([ids, next_tokens], dim=1)
+                done = done | (next_tokens.squeeze(-1) == eos_token_id)
+                if done.all():
+                    break
+                next_ids = next_tokens
         return ids
 
+    @torch.no_grad()
+    def beam_search(self, memory, num_beams=4, max_length=128, min_length=1, length_penalty=1.0,
+        pad_token_id=0, bos_token_id=1, eos_token_id=2):
+        K = num_beams
+        dev = memory.xa.device
+        rows = torch.arange(memory.batch_size, device=dev)
+        memory = memory.expand(K)
+        cache = self.processor.init_cache(memory.batch_size, max_length)
+        ids = torch.full((memory.batch_size, 1), bos_token_id, dtype=torch.long, device=dev)
+        scores = torch.zeros(rows.shape[0], K, device=dev)
+        scores[:, 1:] = float("-inf")
+        best = torch.full((rows.shape[0], max_length), pad_token_id, dtype=torch.long, device=dev)
+        best_score = torch.full((rows.shape[0],), float("-inf"), device=dev)
+
+        for step in range(1, max_length):
+            n = rows.shape[0]
+            logprobs = F.log_softmax(self.decode(ids[:, -1:], memory, cache=cache)[:, -1].float(), dim=-1)
+            if step <= min_length:
+                logprobs[:, eos_token_id] = float("-inf")
+            vocab = logprobs.shape[-1]
+            top, idx = (scores.unsqueeze(-1) + logprobs.view(n, K, vocab)).view(n, -1).topk(2 * K, dim=-1)
+            src = torch.arange(n, device=dev).unsqueeze(-1) * K + idx // vocab
+            token = idx % vocab
+            is_eos = token == eos_token_id
+
+            fin_score, fin_j = torch.where(is_eos, top / step ** length_penalty, float("-inf")).max(dim=-1)
+            better = fin_score > best_score[rows]
+            if better.any():
+                r = better.nonzero().squeeze(-1)
+                best[rows[r]] = pad_token_id
+                best[rows[r], :step] = ids[src[r, fin_j[r]]]
+                best[rows[r], step] = eos_token_id
+                best_score[rows[r]] = fin_score[r]
+
+            scores, j = top.masked_fill(is_eos, float("-inf")).topk(K, dim=-1)
+            src = src.gather(1, j).view(-1)
+            ids = torch.cat([ids[src], token.gather(1, j).view(-1, 1)], dim=1)
+            for c in cache:
+                c.reorder(src)
+
+            done = best_score[rows] >= scores[:, 0] / step ** length_penalty
+            if done.any():
+                keep = (~done).nonzero().squeeze(-1)
+                if keep.numel() == 0:
+                    break
+                flat = (keep.unsqueeze(-1) * K + torch.arange(K, device=dev)).view(-1)
+                rows, scores, ids = rows[keep], scores[keep], ids[flat]
+                for c in cache:
+                    c.reorder(flat)
+                memory = memory.select(keep)
+        else:
+            final = scores[:, 0] / max(max_length - 1, 1) ** length_penalty
+            better = final > best_score[rows]
+            best[rows[better]] = ids.view(rows.shape[0], K, -1)[better, 0]
+
+        width = int((best != pad_token_id).any(dim=0).nonzero().max()) + 1
+        return best[:, :width]
+
+    @torch.no_grad()
+    def transcribe(self, spectrogram, tokenizer=None, window=1024, overlap=128, batch_size=8,
+        max_length=128, num_beams=1, **kwargs):
+        pad_token_id = getattr(tokenizer, "pad_token_id", 0)
+        bos_token_id = getattr(tokenizer, "bos_token_id", 1)
+        eos_token_id = getattr(tokenizer, "eos_token_id", 2)
+        x = spectrogram[0] if spectrogram.dim() == 3 else spectrogram
+        T = x.shape[-1]
+        step = window - overlap
+        starts = list(range(0, max(T - overlap, 1), step))
+        pieces = []
+        for b in range(0, len(starts), batch_size):
+            chunk = [x[:, s:s + window] for s in starts[b:b + batch_size]]
+            n = torch.tensor([c.shape[-1] for c in chunk], device=x.device)
+            batch = x.new_zeros(len(chunk), x.shape[0], int(n.max()))
+            for i, c in enumerate(chunk):
+                batch[i, :, :c.shape[-1]] = c
+            ids = self.generate(spectrogram=batch, lengths={"spectrogram": n}, tokenizer=tokenizer,
+                max_length=max_length, num_beams=num_beams, **kwargs)
+            pieces += [[t for t in row if t not in (pad_token_id, bos_token_id, eos_token_id)] for row in ids.tolist()]
+        out = pieces[0]
+        for piece, s in zip(pieces[1:], starts[1:]):
+            width = min(window, T - s + overlap)
+            span = int(math.ceil(1.5 * len(piece) * overlap / max(width, 1))) + 2
+            out = stitch_tokens(out, piece, min(span, len(out), len(piece)))
+        return out
+
     @property
     def config(self):
         class Config:
@@ -884,6 +1427,304 @@ class Echo(nn.Module):
                 })
         return Config()
 
+def shrink_vocab(model, keep):
+    # keep[new_id] = old_id, e.g. from prune_tokenizer; the output projection is tied so it shrinks with the embedding
+    old = model.processor.token
+    token = nn.Embedding(len(keep), old.embedding_dim, device=old.weight.device, dtype=old.weight.dtype)
+    with torch.no_grad():
+        token.weight.copy_(old.weight[keep.to(old.weight.device)])
+    model.processor.token = token
+    model.param = replace(model.param, vocab=len(keep))
+    return model
+
+def save_dimensions(param, path):
+    # architecture sidecar so serving/tools rebuild exactly the model a checkpoint was trained as
+    keys = ("vocab", "mels", "ctx", "dims", "head", "layer", "act", "features")
+    with open(path, "w") as f:
+        json.dump({k: getattr(param, k) for k in keys}, f, indent=2)
+
+def model_args(parser):
+    # defaults follow main()
+    parser.add_argument("--features", nargs="+", default=["spectrogram", "pitch"])
+    parser.add_argument("--mels", type=int, default=128)
+    parser.add_argument("--ctx", type=int, default=2048)
+    parser.add_argument("--dims", type=int, default=512)
+    parser.add_argument("--head", type=int, default=4)
+    parser.add_argument("--layer", type=int, default=4)
+    parser.add_argument("--act", default="swish")
+    return parser
+
+def load_model(args, tokenizer, checkpoint=None):
+    # dimensions.json next to the checkpoint (or one directory up, for Trainer checkpoint-N folders) wins over CLI args
+    dims = {"vocab": tokenizer.get_vocab_size(), "mels": args.mels, "ctx": args.ctx, "dims": args.dims,
+            "head": args.head, "layer": args.layer, "act": args.act, "features": list(args.features)}
+    if checkpoint is not None:
+        base = os.path.dirname(os.path.abspath(checkpoint))
+        for sidecar in (os.path.join(base, "dimensions.json"), os.path.join(os.path.dirname(base), "dimensions.json")):
+            if os.path.exists(sidecar):
+                with open(sidecar) as f:
+                    dims.update(json.load(f))
+                break
+    model = Echo(Dimensions(debug=set(), tokenizer=tokenizer, **dims))
+    if checkpoint is not None:
+        state = torch.load(checkpoint, map_location=model.device)
+        # strict loading does not flag weights for a blockA branch that is None in this model
+        dropped = sorted({k.split(".")[2] for k in state if k.startswith("processor.blockA.") and model.processor.blockA[k.split(".")[2]] is None})
+        if dropped:
+            raise RuntimeError(f"checkpoint has {dropped} encoder branches but the model was built with features={dims['features']}")
+        model.load_state_dict(state, strict=True)
+    return model
+
+class ContinuousBatcher:
+    def __init__(self, model, slots=8, max_length=128, min_length=1, feature="spectrogram", tokenizer=None, num_blocks=None, block_size=16):
+        self.model = model.eval()
+        self.bridge = model.processor
+        self.slots = slots
+        self.max_length = max_length
+        self.min_length = min_length
+        self.feature = feature
+        self.pad_token_id = getattr(tokenizer, "pad_token_id", 0)
+        self.bos_token_id = getattr(tokenizer, "bos_token_id", 1)
+        self.eos_token_id = getattr(tokenizer, "eos_token_id", 2)
+        self.pending = []
+        self.admitted = []
+        self.failed = []
+        self.active = 0
+        w = self.bridge.token.weight
+        if num_blocks is not None:
+            self.pages, self.cache = paged_cache(self.bridge.blockB, num_blocks, block_size, slots, dtype=w.dtype, device=w.device)
+        else:
+            self.pages = None
+            self.cache = [SlotKVCache(slots, max_length, b.head, b.head_dim, dtype=w.dtype, device=w.device) for b in self.bridge.blockB]
+        self.keys = [None] * slots
+        self.features = [None] * slots
+        self.tokens = [[] for _ in range(slots)]
+        self.last = torch.full((slots,), self.bos_token_id, dtype=torch.long, device=w.device)
+        self.pos = torch.zeros(slots, dtype=torch.long, device=w.device)
+        self.frames = [0] * slots
+        self.xa = self.kv = self.mask = None
+
+    @property
+    def idle(self):
+        return self.active == 0 and not self.pending
+
+    def add(self, features, key=None):
+        key = key if key is not None else len(self.pending) + self.active
+        self.pending.append((key, features))
+        return key
+
+    def reserve(self, frames, like):
+        if self.xa is not None and self.xa.shape[1] >= frames:
+            return
+        old = self.xa.shape[1] if self.xa is not None else 0
+        cap = max(frames, 2 * old)
+        xa = like.xa.new_zeros(self.slots, cap, like.xa.shape[-1])
+        kv = [(k.new_zeros(self.slots, k.shape[1], cap, k.shape[-1]), v.new_zeros(self.slots, v.shape[1], cap, v.shape[-1])) for k, v in like.kv]
+        mask = torch.zeros(self.slots, cap, dtype=torch.bool, device=xa.device)
+        if self.xa is not None:
+            xa[:, :old] = self.xa
+            mask[:, :old] = self.mask
+            for (k, v), (k0, v0) in zip(kv, self.kv):
+                k[:, :, :old], v[:, :, :old] = k0, v0
+        self.xa, self.kv, self.mask = xa, kv, mask
+
+    @torch.no_grad()
+    def admit(self):
+        self.admitted, self.failed = [], []
+        free = self.slots - self.active
+        if self.pages is not None:
+            grow = sum(self.pages.needed(slot, int(self.pos[slot]) + 1) for slot in range(self.active))
+            free = min(free, self.pages.available - grow)
+        if free <= 0 or not self.pending:
+            return
+        batch, self.pending = self.pending[:free], self.pending[free:]
+        try:
+            self.place(batch)
+        except Exception as e:
+            # a bad utterance must not take its batch-mates down: retry one at a time and report the failures
+            if len(batch) == 1:
+                self.failed.append((batch[0][0], e))
+                return
+            for item in batch:
+                try:
+                    self.place([item])
+                except Exception as e:
+                    self.failed.append((item[0], e))
+
+    def place(self, batch):
+        dev = self.last.device
+        n = torch.tensor([f.shape[-1] for _, f in batch], device=dev)
+        x = torch.zeros(len(batch), batch[0][1].shape[0], int(n.max()), device=dev)
+        for i, (_, f) in enumerate(batch):
+            x[i, :, :f.shape[-1]] = f.to(dev)
+        memory = self.model.encode({self.feature: x}, lengths={self.feature: n})
+        T = memory.xa.shape[1]
+        self.reserve(T, memory)
+        rows = slice(self.active, self.active + len(batch))
+        self.xa[rows] = 0
+        self.xa[rows, :T] = memory.xa
+        self.mask[rows] = False
+        self.mask[rows, :T] = memory.mask if memory.mask is not None else True
+        for (k, v), (k1, v1) in zip(self.kv, memory.kv):
+            k[rows, :, :T], v[rows, :, :T] = k1, v1
+        frames = memory.mask.sum(-1).tolist() if memory.mask is not None else [T] * len(batch)
+        for i, (key, f) in enumerate(batch):
+            slot = self.active + i
+            self.keys[slot], self.features[slot], self.tokens[slot], self.frames[slot] = key, f, [], frames[i]
+            self.admitted.append(key)
+        self.last[rows] = self.bos_token_id
+        self.pos[rows] = 0
+        self.active += len(batch)
+
+    def evict(self, slot):
+        last = self.active - 1
+        if self.pages is not None:
+            self.pages.release(slot)
+            self.pages.move(last, slot)
+        elif slot != last:
+            for c in self.cache:
+                c.move(last, slot)
+        if slot != last:
+            for (k, v) in self.kv:
+                k[slot], v[slot] = k[last], v[last]
+            self.xa[slot], self.mask[slot] = self.xa[last], self.mask[last]
+            self.last[slot], self.pos[slot] = self.last[last], self.pos[last]
+            self.keys[slot], self.features[slot], self.tokens[slot], self.frames[slot] = self.keys[last], self.features[last], self.tokens[last], self.frames[last]
+        self.keys[last], self.features[last], self.tokens[last] = None, None, []
+        self.active -= 1
+
+    def preempt(self):
+        # out of pages: push the newest row back to the queue and recompute it later
+        slot = self.active - 1
+        self.pending.insert(0, (self.keys[slot], self.features[slot]))
+        self.evict(slot)
+
+    @torch.no_grad()
+    def step(self):
+        self.admit()
+        if self.pages is not None:
+            while self.active > 1 and sum(self.pages.needed(slot, int(self.pos[slot]) + 1) for slot in range(self.active)) > self.pages.available:
+                self.preempt()
+        if not self.active:
+            return []
+        n = self.active
+        if self.pages is not None:
+            self.pages.prepare((self.pos[:n] + 1).tolist(), device=self.last.device)
+        width = max(self.frames[:n])
+        memory = EncoderMemory(xa=self.xa[:n, :width], kv=[(k[:n, :, :width], v[:n, :, :width]) for k, v in self.kv],
+            en={}, feature=self.feature, mask=self.mask[:n, :width])
+        logits = self.bridge.slot_decoder(self.last[:n, None], memory, self.cache, self.pos[:n])[:, -1]
+        logits[self.pos[:n] < self.min_length, self.eos_token_id] = float("-inf")
+        next_tokens = logits.argmax(dim=-1)
+        self.last[:n] = next_tokens
+        self.pos[:n] += 1
+        finished = []
+        for slot, (t, p) in enumerate(zip(next_tokens.tolist(), self.pos[:n].tolist())):
+            if t != self.eos_token_id:
+                self.tokens[slot].append(t)
+            if t == self.eos_token_id or p >= self.max_length - 1:
+                finished.append(slot)
+        done = [(self.keys[slot], self.tokens[slot]) for slot in finished]
+        for slot in reversed(finished):
+            self.evict(slot)
+        return done
+
+    def run(self):
+        results = {}
+        while not self.idle:
+            results.update(self.step())
+        return results
+
+class BucketTrainer(Seq2SeqTrainer):
+    def __init__(self, *args, batch_sampler=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batch_sampler = batch_sampler
+
+    def get_train_dataloader(self):
+        if self.batch_sampler is None:
+            return super().get_train_dataloader()
+        dataset, collator = self.train_dataset, self.data_collator
+        if isinstance(dataset, Dataset):
+            dataset = self._remove_unused_columns(dataset, description="Training")
+        else:
+            collator = self._get_collator_with_removed_columns(collator, description="Training")
+        return self.accelerator.prepare(DataLoader(dataset, batch_sampler=self.batch_sampler, collate_fn=collator,
+            num_workers=self.args.dataloader_num_workers, pin_memory=self.args.dataloader_pin_memory,
+            persistent_workers=self.args.dataloader_persistent_workers))
+
+def benchmark_rotary(batch=1, head=4, ctx=2048, head_dim=128, steps=20, dtype=torch.float32):
+    import time
+    from torch.profiler import profile, ProfilerActivity
+    x = torch.randn(batch, head, ctx, head_dim, device=device, dtype=dtype)
+    rope = rotary(dims=head * head_dim, head=head).to(device)
+    with torch.no_grad():
+        freqs = rope(x=ctx)
+        ref = rotary.apply_rotary(x, freqs)
+        out = rotary.apply_rotary_real(x, freqs.real, freqs.imag)
+    print(f"max abs diff: {(ref.float() - out.float()).abs().max().item():.2e}")
+    results = {}
+    for name, fn in (("complex", lambda: rotary.apply_rotary(x, freqs)),
+                     ("real", lambda: rotary.apply_rotary_real(x, freqs.real, freqs.imag))):
+        with torch.no_grad():
+            fn()
+            start = time.perf_counter()
+            for _ in range(steps):
+                fn()
+            if torch.cuda.is_available():
+                torch.cuda.synchronize()
+            elapsed = (time.perf_counter() - start) / steps
+            with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+                fn()
+        allocs = [e for e in prof.events() if e.self_cpu_memory_usage > 0]
+        nbytes = sum(e.self_cpu_memory_usage for e in allocs)
+        results[name] = {"ms": elapsed * 1000, "allocs": len(allocs), "alloc_mb": nbytes / 2**20}
+        print(f"{name:>8}: {elapsed * 1000:.2f} ms/call, {x.numel() / elapsed / 1e6:.0f} Melem/s, "
+              f"{len(allocs)} allocs, {nbytes / 2**20:.1f} MB allocated ({dtype})")
+    return results
+
+def attention_step(dims, head, ctx, batch, steps, backend):
+    import time
+    import resource
+    MultiheadA.sdpa = backend
+    x = torch.randn(batch, ctx, dims, device=device, dtype=dtype)
+    mask = torch.full((ctx, ctx), float("-inf"), device=device, dtype=dtype).triu_(1)
+    attn = MultiheadA(dims, head).eval()
+    if torch.cuda.is_available():
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+    else:
+        base = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    with torch.no_grad():
+        attn(x, mask=mask)
+        start = time.perf_counter()
+        for _ in range(steps):
+            attn(x, mask=mask)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+    elapsed = (time.perf_counter() - start) / steps
+    if torch.cuda.is_available():
+        peak = torch.cuda.max_memory_allocated() - base
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - base
+    return {"ms": elapsed * 1000, "peak_mb": peak / 2**20}
+
+def benchmark_attention(dims=512, head=4, ctx=2048, batch=1, steps=3):
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    sdpa = MultiheadA.sdpa
+    results = {}
+    for name, backend in (("default", False), ("sdpa", True)):
+        if torch.cuda.is_available():
+            results[name] = attention_step(dims, head, ctx, batch, steps, backend)
+        else:
+            # ru_maxrss is a process-lifetime high-water mark, so each path gets a fresh process
+            with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+                results[name] = pool.submit(attention_step, dims, head, ctx, batch, steps, backend).result()
+        r = results[name]
+        print(f"{name:>8}: {r['ms']:.1f} ms/step, peak +{r['peak_mb']:.1f} MB (ctx={ctx}, head={head}, batch={batch})")
+    MultiheadA.sdpa = sdpa
+    return results
+
 def main():
     token = ""
     log_dir = os.path.join('./output/logs', datetime.now().strftime('%m-%d_%H_%M_%S'))
@@ -896,6 +1737,10 @@ def main():
     save_dataset = False
     cache_dir = None
     extract_args = None    
+    bucket_batches = False
+    max_frames = None
+    streaming_eval = False
+    loss_chunk = 0
 
     extract_args = {
         "waveform": False,
@@ -914,7 +1759,7 @@ def main():
     }
 
     param = Dimensions(
-        vocab=40000,
+        vocab=tokenizer.get_vocab_size(),
         mels=128,
         ctx=2048,
         dims=512,
@@ -929,12 +1774,16 @@ def main():
     train_dataset, test_dataset = prepare_datasets(tokenizer, token, sanity_check=sanity_check, sample_rate=16000, streaming=streaming,
         load_saved=load_saved, save_dataset=save_dataset, cache_dir=cache_dir, extract_args=extract_args, max_ctx=param.ctx)
 
-    model = Echo(param).to('cuda')
+    theBridge.loss_chunk = loss_chunk
+    model = Echo(param, topk=1 if streaming_eval else 0).to('cuda')
+    save_dimensions(param, os.path.join(log_dir, "dimensions.json"))
     print(f"Trainable parameters: {sum(p.numel() for p in model.parameters() if p.requires_grad):,}")
     print(f"Total parameters: {sum(p.numel() for p in model.parameters()):,}")
     
     from functools import partial
     metrics_fn = partial(compute_metrics,  print_pred=True, num_samples=1, tokenizer=tokenizer, model=model)
+    if streaming_eval:
+        metrics_fn = StreamingMetrics(tokenizer, model=model, print_pred=True, num_samples=1)
 
     if sanity_check:
         training_args = Seq2SeqTrainingArguments(
@@ -956,7 +1805,7 @@ def main():
             label_names=["labels"],
             save_safetensors=False,
             eval_on_start=True,
-            batch_eval_metrics=False,
+            batch_eval_metrics=streaming_eval,
             disable_tqdm=False,
             include_tokens_per_second=True,
             include_num_input_tokens_seen=True,
@@ -983,7 +1832,7 @@ def main():
             label_names=["labels"],
             save_safetensors=False,
             eval_on_start=True,
-            batch_eval_metrics=False,
+            batch_eval_metrics=streaming_eval,
             disable_tqdm=False,
             include_tokens_per_second=True,
             include_num_input_tokens_seen=True,
@@ -995,7 +1844,14 @@ def main():
     amsgrad=False, foreach=False, fused=False, capturable=False, differentiable=False, maximize=False)
     scheduler = torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, T_max=training_args.max_steps, eta_min=1e-9, last_epoch=-1)
 
-    trainer = Seq2SeqTrainer(
+    batch_sampler = None
+    if bucket_batches and not streaming:
+        frames, labels = feature_lengths(train_dataset)
+        batch_sampler = BucketBatchSampler(frames, labels, batch_size=training_args.per_device_train_batch_size,
+            max_frames=max_frames, drop_last=training_args.dataloader_drop_last, seed=training_args.seed)
+        print(f"Bucketing: {batch_sampler.stats()}")
+
+    trainer = BucketTrainer(
         args=training_args,
         model=model,
         train_dataset=train_dataset,
@@ -1003,7 +1859,8 @@ def main():
         data_collator=DataCollator(tokenizer=tokenizer),
         preprocess_logits_for_metrics=preprocess_logits_for_metrics,
         compute_metrics=metrics_fn,
-        optimizers=(optimizer, scheduler)
+        optimizers=(optimizer, scheduler),
+        batch_sampler=batch_sampler,
     )
 
     model.init_weights()
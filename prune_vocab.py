@@ -0,0 +1,55 @@
+import os
+import argparse
+
+import numpy as np
+import torch
+
+from model_b import shrink_vocab, model_args, load_model, save_dimensions
+from echoutils import setup_tokenizer, prune_tokenizer
+
+def load_transcripts(paths=None, token=None, split="train", take=None):
+    if paths:
+        lines = []
+        for path in paths:
+            with open(path, encoding="utf-8") as f:
+                lines.extend(line.strip() for line in f if line.strip())
+        return lines
+    from datasets import load_dataset
+    ds = load_dataset("google/fleurs", "en_us", token=token, split=split, trust_remote_code=True)
+    if take is not None:
+        ds = ds.select(range(min(take, len(ds))))
+    return ds["transcription"]
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokenizer", default="./tokenizer.json")
+    parser.add_argument("--checkpoint", default=None)
+    parser.add_argument("--transcripts", nargs="*", default=None, help="text files, one transcript per line; defaults to the fleurs train split")
+    parser.add_argument("--take", type=int, default=None)
+    parser.add_argument("--min-count", type=int, default=1)
+    parser.add_argument("--max-size", type=int, default=None)
+    parser.add_argument("--out", default="./pruned")
+    model_args(parser)
+    args = parser.parse_args()
+
+    tokenizer = setup_tokenizer(args.tokenizer)
+    transcripts = load_transcripts(args.transcripts, take=args.take)
+    pruned, keep, counts = prune_tokenizer(tokenizer, transcripts, min_count=args.min_count, max_size=args.max_size)
+    covered = counts[keep.numpy()].sum() / max(counts.sum(), 1)
+    print(f"vocab {tokenizer.get_vocab_size()} -> {len(keep)} ({len(transcripts)} transcripts, {covered:.2%} of token occurrences kept)")
+
+    os.makedirs(args.out, exist_ok=True)
+    pruned.save_pretrained(args.out)
+    np.save(os.path.join(args.out, "keep.npy"), keep.numpy())
+
+    if args.checkpoint is not None:
+        model = load_model(args, tokenizer, checkpoint=args.checkpoint)
+        before = sum(p.numel() for p in model.parameters())
+        shrink_vocab(model, keep)
+        after = sum(p.numel() for p in model.parameters())
+        torch.save(model.state_dict(), os.path.join(args.out, "model.pt"))
+        save_dimensions(model.param, os.path.join(args.out, "dimensions.json"))
+        print(f"parameters {before:,} -> {after:,}")
+
+if __name__ == "__main__":
+    main()
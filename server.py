@@ -0,0 +1,347 @@
+import io
+import json
+import time
+import queue
+import asyncio
+import argparse
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+
+import numpy as np
+import torch
+
+from model_b import ContinuousBatcher, model_args, load_model
+from echoutils import setup_tokenizer
+
+@dataclass
+class Request:
+    features: torch.Tensor
+    future: asyncio.Future
+    loop: asyncio.AbstractEventLoop
+    arrived: float = field(default_factory=time.perf_counter)
+    finished: bool = False
+
+class Metrics:
+    def __init__(self, window=1000):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.batches = 0
+        self.rows = 0
+        self.steps = 0
+        self.tokens = 0
+        self.busy = 0.0
+        self.started = time.perf_counter()
+        self.queue_ms = deque(maxlen=window)
+        self.latency_ms = deque(maxlen=window)
+
+    def batch(self, rows, steps, busy):
+        with self.lock:
+            self.batches += 1
+            self.rows += rows
+            self.steps += steps
+            self.busy += busy
+
+    def request(self, queue_ms, latency_ms, tokens):
+        with self.lock:
+            self.requests += 1
+            self.tokens += tokens
+            self.queue_ms.append(queue_ms)
+            self.latency_ms.append(latency_ms)
+
+    def snapshot(self, max_batch, depth=0):
+        def pct(values, q):
+            return float(np.percentile(values, q)) if values else 0.0
+        with self.lock:
+            elapsed = time.perf_counter() - self.started
+            return {
+                "requests": self.requests,
+                "batches": self.batches,
+                "queue_depth": depth,
+                "batch_fill": self.rows / max(self.batches * max_batch, 1),
+                "mean_batch_size": self.rows / max(self.batches, 1),
+                "decode_steps": self.steps,
+                "tokens_per_sec": self.tokens / max(self.busy, 1e-9),
+                "utilization": self.busy / max(elapsed, 1e-9),
+                "queue_ms_p50": pct(self.queue_ms, 50),
+                "queue_ms_p95": pct(self.queue_ms, 95),
+                "latency_ms_p50": pct(self.latency_ms, 50),
+                "latency_ms_p95": pct(self.latency_ms, 95),
+            }
+
+class BatchWorker(threading.Thread):
+    def __init__(self, model, tokenizer=None, max_batch=8, max_wait_ms=20, max_length=128, min_length=1):
+        super().__init__(daemon=True)
+        self.model = model.eval()
+        self.tokenizer = tokenizer
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self.max_length = max_length
+        self.min_length = min_length
+        self.pad_token_id = getattr(tokenizer, "pad_token_id", 0)
+        self.bos_token_id = getattr(tokenizer, "bos_token_id", 1)
+        self.eos_token_id = getattr(tokenizer, "eos_token_id", 2)
+        self.queue = queue.Queue()
+        self.metrics = Metrics()
+        self.mels = model.param.mels
+
+    def check(self, features):
+        if features.ndim != 2 or features.shape[0] != self.mels:
+            raise ValueError(f"expected a ({self.mels}, frames) spectrogram, got shape {tuple(features.shape)}")
+        if features.shape[1] == 0:
+            raise ValueError("spectrogram has no frames")
+        if not bool(torch.isfinite(features).all()):
+            raise ValueError("spectrogram contains NaN or infinite values")
+
+    def submit(self, features, loop):
+        self.check(features)
+        future = loop.create_future()
+        self.queue.put(Request(features=features, future=future, loop=loop))
+        return future
+
+    def stop(self):
+        self.queue.put(None)
+
+    def collect(self):
+        first = self.queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = first.arrived + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            try:
+                item = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                self.queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def run(self):
+        while True:
+            batch = self.collect()
+            if batch is None:
+                break
+            try:
+                self.process(batch)
+            except Exception as e:
+                if len(batch) == 1:
+                    batch[0].loop.call_soon_threadsafe(self.fail, batch[0].future, e)
+                    continue
+                # retry the unfinished requests one by one so only the offending one fails
+                for r in batch:
+                    if r.finished:
+                        continue
+                    try:
+                        self.process([r])
+                    except Exception as e:
+                        r.loop.call_soon_threadsafe(self.fail, r.future, e)
+
+    @staticmethod
+    def resolve(future, result):
+        if not future.done():
+            future.set_result(result)
+
+    @staticmethod
+    def fail(future, error):
+        if not future.done():
+            future.set_exception(error)
+
+    def finish(self, r, ids, start, batch_size):
+        r.finished = True
+        now = time.perf_counter()
+        result = {
+            "ids": ids,
+            "queue_ms": (start - r.arrived) * 1000,
+            "latency_ms": (now - r.arrived) * 1000,
+            "batch_size": batch_size,
+        }
+        if self.tokenizer is not None:
+            result["text"] = self.tokenizer.decode(ids)
+        self.metrics.request(result["queue_ms"], result["latency_ms"], len(ids))
+        r.loop.call_soon_threadsafe(self.resolve, r.future, result)
+
+    @torch.no_grad()
+    def process(self, batch):
+        start = time.perf_counter()
+        model = self.model
+        dev = model.device
+        B = len(batch)
+        n = torch.tensor([r.features.shape[-1] for r in batch], device=dev)
+        x = torch.zeros(B, batch[0].features.shape[0], int(n.max()), device=dev)
+        for i, r in enumerate(batch):
+            x[i, :, :r.features.shape[-1]] = r.features.to(dev)
+        memory = model.encode({"spectrogram": x}, lengths={"spectrogram": n})
+        cache = model.processor.init_cache(B, self.max_length)
+        next_ids = torch.full((B, 1), self.bos_token_id, dtype=torch.long, device=dev)
+        done = torch.zeros(B, dtype=torch.bool, device=dev)
+        tokens = [[] for _ in range(B)]
+        steps = 0
+        for step in range(self.max_length - 1):
+            logits = model.decode(next_ids, memory, cache=cache)[:, -1]
+            if step < self.min_length:
+                logits[:, self.eos_token_id] = float("-inf")
+            next_tokens = logits.argmax(dim=-1).masked_fill(done, self.pad_token_id)
+            finished = ~done & (next_tokens == self.eos_token_id)
+            for i, t in zip((~done & ~finished).nonzero().squeeze(-1).tolist(), next_tokens[~done & ~finished].tolist()):
+                tokens[i].append(t)
+            for i in finished.nonzero().squeeze(-1).tolist():
+                self.finish(batch[i], tokens[i], start, B)
+            done |= finished
+            steps += 1
+            if done.all():
+                break
+            next_ids = next_tokens.unsqueeze(-1)
+        for i in (~done).nonzero().squeeze(-1).tolist():
+            self.finish(batch[i], tokens[i], start, B)
+        self.metrics.batch(B, steps, time.perf_counter() - start)
+
+class ContinuousWorker(BatchWorker):
+    def __init__(self, model, tokenizer=None, max_batch=8, max_wait_ms=20, max_length=128, min_length=1, num_blocks=None, block_size=16):
+        super().__init__(model, tokenizer, max_batch, max_wait_ms, max_length, min_length)
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.sched = self.scheduler()
+        self.requests = {}
+        self.started = {}
+        self.next_key = 0
+
+    def scheduler(self):
+        return ContinuousBatcher(self.model, slots=self.max_batch, max_length=self.max_length, min_length=self.min_length,
+            tokenizer=self.tokenizer, num_blocks=self.num_blocks, block_size=self.block_size)
+
+    def drain(self, block):
+        try:
+            item = self.queue.get() if block else self.queue.get_nowait()
+        except queue.Empty:
+            return True
+        while item is not None:
+            key, self.next_key = self.next_key, self.next_key + 1
+            self.requests[key] = item
+            self.sched.add(item.features, key=key)
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                return True
+        return False
+
+    def run(self):
+        running = True
+        while running or not self.sched.idle:
+            if running:
+                running = self.drain(block=self.sched.idle)
+            if self.sched.idle:
+                continue
+            start = time.perf_counter()
+            try:
+                done = self.sched.step()
+            except Exception as e:
+                for r in self.requests.values():
+                    r.loop.call_soon_threadsafe(self.fail, r.future, e)
+                self.requests.clear()
+                self.sched = self.scheduler()
+                continue
+            for key, e in self.sched.failed:
+                r = self.requests.pop(key)
+                r.loop.call_soon_threadsafe(self.fail, r.future, e)
+            for key in self.sched.admitted:
+                self.started[key] = start
+            for key, ids in done:
+                self.finish(self.requests.pop(key), ids, self.started.pop(key), self.sched.active + len(done))
+            self.metrics.batch(self.sched.active + len(done), 1, time.perf_counter() - start)
+
+class Server:
+    reasons = {200: "OK", 400: "Bad Request", 404: "Not Found", 500: "Internal Server Error"}
+
+    def __init__(self, worker):
+        self.worker = worker
+
+    def parse(self, body, headers):
+        try:
+            if headers.get("content-type", "").startswith("application/json"):
+                x = np.asarray(json.loads(body)["spectrogram"], dtype=np.float32)
+            else:
+                x = np.load(io.BytesIO(body), allow_pickle=False).astype(np.float32, copy=False)
+        except (OSError, EOFError, TypeError, ValueError) as e:
+            raise ValueError(f"could not read spectrogram: {e}")
+        if x.ndim == 3 and x.shape[0] == 1:
+            x = x[0]
+        x = torch.from_numpy(np.ascontiguousarray(x))
+        self.worker.check(x)
+        return x
+
+    async def handle(self, reader, writer):
+        try:
+            method, path, _ = (await reader.readline()).decode().split(" ", 2)
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b"\r\n", b"\n", b""):
+                    break
+                k, v = line.decode().split(":", 1)
+                headers[k.strip().lower()] = v.strip()
+            body = await reader.readexactly(int(headers.get("content-length", 0)))
+            if method == "GET" and path == "/metrics":
+                status, payload = 200, self.worker.metrics.snapshot(self.worker.max_batch, self.worker.queue.qsize())
+            elif method == "POST" and path == "/transcribe":
+                features = self.parse(body, headers)
+                status, payload = 200, await self.worker.submit(features, asyncio.get_running_loop())
+            else:
+                status, payload = 404, {"error": f"no route for {method} {path}"}
+        except (ValueError, KeyError, asyncio.IncompleteReadError) as e:
+            status, payload = 400, {"error": str(e)}
+        except Exception as e:
+            status, payload = 500, {"error": str(e)}
+        data = json.dumps(payload).encode()
+        writer.write(f"HTTP/1.1 {status} {self.reasons[status]}\r\nContent-Type: application/json\r\n"
+            f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode() + data)
+        try:
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8000, unix=None):
+        if unix is not None:
+            server = await asyncio.start_unix_server(self.handle, path=unix)
+        else:
+            server = await asyncio.start_server(self.handle, host=host, port=port)
+        async with server:
+            await server.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--checkpoint", default=None)
+    parser.add_argument("--tokenizer", default="./tokenizer.json")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--unix", default=None)
+    parser.add_argument("--max-batch", type=int, default=8)
+    parser.add_argument("--max-wait-ms", type=float, default=20)
+    parser.add_argument("--max-length", type=int, default=128)
+    parser.add_argument("--continuous", action="store_true")
+    parser.add_argument("--kv-blocks", type=int, default=None)
+    parser.add_argument("--block-size", type=int, default=16)
+    model_args(parser)
+    args = parser.parse_args()
+
+    tokenizer = setup_tokenizer(args.tokenizer)
+    model = load_model(args, tokenizer, checkpoint=args.checkpoint)
+    if model.param.features != ["spectrogram"]:
+        print(f"model has {model.param.features} branches; requests only carry a spectrogram, so only that branch is run")
+
+    if args.continuous:
+        worker = ContinuousWorker(model, tokenizer=tokenizer, max_batch=args.max_batch, max_wait_ms=args.max_wait_ms, max_length=args.max_length,
+            num_blocks=args.kv_blocks, block_size=args.block_size)
+    else:
+        worker = BatchWorker(model, tokenizer=tokenizer, max_batch=args.max_batch, max_wait_ms=args.max_wait_ms, max_length=args.max_length)
+    worker.start()
+    try:
+        asyncio.run(Server(worker).serve(host=args.host, port=args.port, unix=args.unix))
+    finally:
+        worker.stop()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,27 @@
+import torch
+
+import model_b as mb
+from echoutils import BlockTable
+
+from test_decoding import tiny
+
+
+def test_paged_batcher_matches_generate_and_indexes_once_per_step(monkeypatch):
+    model = tiny(layer=4)
+    torch.manual_seed(1)
+    specs = [torch.randn(16, int(t)) for t in torch.randint(8, 40, (6,))]
+    with torch.no_grad():
+        ref = [[t for t in model.generate(spectrogram=x[None], max_length=12)[0].tolist() if t not in (0, 1, 2)] for x in specs]
+
+    calls = []
+    index = BlockTable.index
+    monkeypatch.setattr(BlockTable, "index", lambda self, *a, **k: calls.append(1) or index(self, *a, **k))
+    batcher = mb.ContinuousBatcher(model, slots=4, max_length=12, num_blocks=16, block_size=4)
+    for i, x in enumerate(specs):
+        batcher.add(x, key=i)
+    steps, out = 0, {}
+    while not batcher.idle:
+        out.update(batcher.step())
+        steps += 1
+    assert [out[i] for i in range(len(specs))] == ref
+    assert len(calls) == steps
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+import datasets
+
+from echoutils import BucketBatchSampler, FeatureStore, feature_lengths
+
+
+def utterances(n=40, mels=4):
+    rng = np.random.default_rng(0)
+    rows = []
+    for i in range(n):
+        frames = int(rng.integers(3, 60))
+        rows.append({"spectrogram": rng.standard_normal((mels, frames)).astype(np.float32),
+            "pitch": rng.random((1, frames)).astype(np.float32) if i % 3 else None,
+            "labels": rng.integers(3, 100, int(rng.integers(1, 20))).tolist()})
+    return rows
+
+
+def hf_dataset(rows):
+    return datasets.Dataset.from_list([{"i": i} for i in range(len(rows))]).map(
+        lambda x: rows[x["i"]], remove_columns=["i"])
+
+
+@pytest.mark.parametrize("view", ["plain", "select", "shuffle"])
+def test_feature_lengths_reads_arrow_offsets(view, monkeypatch):
+    rows = utterances()
+    ds = hf_dataset(rows)
+    order = list(range(len(rows)))
+    if view == "select":
+        order = order[25:] + order[3:9]
+        ds = ds.select(order)
+    elif view == "shuffle":
+        ds = ds.shuffle(seed=1)
+        order = ds._indices.column("indices").to_pylist()
+
+    def no_items(*args, **kwargs):
+        raise AssertionError("feature_lengths decoded the dataset")
+    monkeypatch.setattr(datasets.Dataset, "__getitem__", no_items)
+    monkeypatch.setattr(datasets.Dataset, "__iter__", no_items)
+
+    frames, labels = feature_lengths(ds)
+    assert frames == [rows[i]["spectrogram"].shape[-1] for i in order]
+    assert labels == [len(rows[i]["labels"]) for i in order]
+    pitch, _ = feature_lengths(ds, key="pitch")
+    assert pitch == [0 if rows[i]["pitch"] is None else rows[i]["pitch"].shape[-1] for i in order]
+
+
+def test_feature_lengths_matches_feature_store(tmp_path):
+    rows = utterances()
+    store = FeatureStore.write(hf_dataset(rows), str(tmp_path / "train.store"))
+    assert feature_lengths(store) == feature_lengths(hf_dataset(rows))
+
+
+@pytest.mark.parametrize("drop_last", [False, True])
+def test_frame_budget_batches(drop_last):
+    frames = np.random.default_rng(0).integers(10, 400, 500)
+    sampler = BucketBatchSampler(frames, batch_size=16, max_frames=2000, bucket_size=64, drop_last=drop_last)
+    batches = list(sampler)
+    seen = [i for b in batches for i in b]
+    assert len(seen) == len(set(seen))
+    assert all(frames[b].max() * len(b) <= 2000 or len(b) == 1 for b in batches)
+    if drop_last:
+        kept = BucketBatchSampler(frames, batch_size=16, max_frames=2000, bucket_size=64)
+        assert len(batches) == len(kept) - -(-len(frames) // 64)  # one leftover batch per bucket
+    else:
+        assert sorted(seen) == list(range(len(frames)))
+
+
+def test_sampler_needs_a_batch_limit():
+    with pytest.raises(ValueError, match="batch_size or max_frames"):
+        BucketBatchSampler([10, 20, 30], batch_size=None)
+    assert len(list(BucketBatchSampler([10, 20, 30], batch_size=None, max_frames=40))) == 2
@@ -0,0 +1,45 @@
+import torch
+import pytest
+
+import model_b as mb
+
+
+def tiny(layer=2, features=("spectrogram",)):
+    torch.manual_seed(0)
+    param = mb.Dimensions(vocab=100, mels=16, ctx=64, dims=32, head=4, layer=layer, act="swish",
+        debug=[], features=list(features), tokenizer=None)
+    model = mb.Echo(param).eval()
+    with torch.no_grad():
+        model.processor.positional.normal_()
+    return model
+
+
+@pytest.mark.parametrize("sdpa", [False, True])
+@pytest.mark.parametrize("layer", [2, 4])
+def test_cached_generation_matches_full_pass(sdpa, layer, monkeypatch):
+    monkeypatch.setattr(mb.MultiheadA, "sdpa", sdpa)
+    model = tiny(layer)
+    x = torch.randn(2, 16, 40)
+    with torch.no_grad():
+        ids = model.generate(spectrogram=x, max_length=16, min_length=15)
+        memory = model.encode({"spectrogram": x})
+        full = model.decode(ids, memory)
+        cache = model.processor.init_cache(2, 16)
+        cached = torch.cat([model.decode(ids[:, i:i + 1], memory, cache=cache) for i in range(ids.shape[1])], dim=1)
+        steps = full[:, :-1].clone()
+        steps[..., 2] = float("-inf")
+        greedy = torch.cat([ids[:, :1], steps.argmax(-1)], dim=1)
+    assert torch.allclose(full, cached, atol=1e-4)
+    assert torch.equal(ids, greedy)
+
+
+def test_decoder_is_causal():
+    model = tiny()
+    x = torch.randn(1, 16, 40)
+    ids = torch.randint(3, 100, (1, 12))
+    changed = ids.clone()
+    changed[:, 8] = (changed[:, 8] + 1) % 100
+    with torch.no_grad():
+        memory = model.encode({"spectrogram": x})
+        a, b = model.decode(ids, memory), model.decode(changed, memory)
+    assert torch.equal(a[:, :8], b[:, :8])
@@ -0,0 +1,31 @@
+import torch
+
+import model_b as mb
+
+from test_decoding import tiny
+
+
+def test_topk_eval_matches_full_logits_without_building_them(monkeypatch):
+    full = tiny()
+    model = tiny()
+    model.topk = 3
+    x = torch.randn(2, 16, 40)
+    ids = torch.randint(3, 100, (2, 9))
+    labels = ids.clone()
+    labels[1, 6:] = 0
+
+    rows = []
+    project = mb.theBridge.project
+    monkeypatch.setattr(mb.theBridge, "project", lambda self, h: rows.append(h.shape[0]) or project(self, h))
+    monkeypatch.setattr(mb.theBridge, "loss_chunk", 5)
+    with torch.no_grad():
+        out = model(input_ids=ids, labels=labels, spectrogram=x)
+    assert max(rows) == 5
+
+    with torch.no_grad():
+        ref = full(input_ids=ids, labels=labels, spectrogram=x)
+    values, top = ref["logits"].log_softmax(-1).topk(3, dim=-1)
+    assert full.topk == 0 and "logits" not in out
+    assert torch.equal(out["ids"], top)
+    assert torch.allclose(out["log_probs"], values, atol=1e-5)
+    assert torch.allclose(out["loss"], ref["loss"], atol=1e-5)
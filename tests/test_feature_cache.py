@@ -0,0 +1,18 @@
+from echoutils import FeatureExtractor, feature_args, feature_kinds
+
+
+class Tok:
+    def __init__(self, vocab):
+        self.vocab = vocab
+
+    def to_str(self):
+        return self.vocab
+
+
+def test_token_aligned_kinds_are_keyed_by_tokenizer(tmp_path):
+    batch = {"transcription": "the cat sat"}
+    old = FeatureExtractor(Tok("full"), cache_dir=str(tmp_path), hop_length=256, mode="mean")
+    new = FeatureExtractor(Tok("pruned"), cache_dir=str(tmp_path), hop_length=256, mode="mean")
+    for kind in feature_kinds:
+        same = old.path(kind, "audio", batch) == new.path(kind, "audio", batch)
+        assert same != ("transcription" in feature_args.get(kind, ())), kind
@@ -0,0 +1,38 @@
+import torch
+import pytest
+
+import model_b as mb
+from echoutils import DataCollator
+
+from test_decoding import tiny
+
+
+class Tok:
+    pad_token_id = 0
+    bos_token_id = 1
+    eos_token_id = 2
+
+
+def utterances(features):
+    torch.manual_seed(1)
+    out = []
+    for frames, tokens in ((40, 9), (25, 4), (33, 6)):
+        f = dict(spectrogram=torch.randn(16, frames), labels=torch.randint(3, 100, (tokens,)).tolist())
+        if "pitch" in features:
+            f["pitch"] = torch.rand(1, frames) * 200 + 80
+        out.append(f)
+    return out
+
+
+@pytest.mark.parametrize("sdpa", [False, True])
+@pytest.mark.parametrize("features", [("spectrogram",), ("spectrogram", "pitch")])
+def test_padded_batch_matches_single_utterances(sdpa, features, monkeypatch):
+    monkeypatch.setattr(mb.MultiheadA, "sdpa", sdpa)
+    model = tiny(features=features)
+    feats = utterances(features)
+    collate = DataCollator(tokenizer=Tok())
+    with torch.no_grad():
+        batch = model(**collate(feats))["logits"]
+        for i, f in enumerate(feats):
+            single = model(**collate([f]))["logits"][0]
+            assert torch.allclose(single, batch[i, :single.shape[0]], atol=1e-4)
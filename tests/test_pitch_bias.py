@@ -0,0 +1,54 @@
+import torch
+import pytest
+
+import model_b as mb
+from echoutils import KVCache
+
+
+def attention(monkeypatch, sdpa):
+    monkeypatch.setattr(mb.MultiheadA, "sdpa", sdpa)
+    monkeypatch.setattr(mb.MultiheadA, "pbias_rank", 8)
+    torch.manual_seed(0)
+    return mb.MultiheadA(32, 4, rotary_emb=False, use_pbias=True).eval()
+
+
+def f0(batch, frames):
+    return torch.rand(batch, frames) * 200 + 80
+
+
+@pytest.mark.parametrize("sdpa", [False, True])
+def test_cached_steps_use_their_own_pitch_positions(sdpa, monkeypatch):
+    attn = attention(monkeypatch, sdpa)
+    x = torch.randn(2, 12, 32)
+    en = {"f0": f0(2, 12)}
+    mask = torch.full((12, 12), float("-inf")).triu_(1)
+    cache = KVCache(2, 12, 4, 8, dtype=torch.float32)
+    with torch.no_grad():
+        full = attn(x, mask=mask, en=en)[0]
+        steps = torch.cat([attn(x[:, i:i + 1], mask=mask, en=en, kv_cache=cache, input_pos=torch.tensor([i]))[0]
+            for i in range(12)], dim=1)
+    assert torch.allclose(full, steps, atol=1e-5)
+
+
+@pytest.mark.parametrize("sdpa", [False, True])
+def test_slot_positions_index_pitch_rows(sdpa, monkeypatch):
+    attn = attention(monkeypatch, sdpa)
+    x, xa = torch.randn(2, 6, 32), torch.randn(2, 20, 32)
+    en = {"f0": f0(2, 20)}
+    with torch.no_grad():
+        full = attn(x, xa=xa, en=en)[0]
+        pos = torch.tensor([[4], [1]])
+        slots = attn(x[torch.arange(2), pos[:, 0]].unsqueeze(1), xa=xa, en=en, positions=pos)[0]
+    assert torch.allclose(full[torch.arange(2), pos[:, 0]], slots[:, 0], atol=1e-5)
+
+
+@pytest.mark.parametrize("sdpa", [False, True])
+def test_beam_expanded_memory_keeps_pitch_bias(sdpa, monkeypatch):
+    attn = attention(monkeypatch, sdpa)
+    x, xa, pitch = torch.randn(6, 5, 32), torch.randn(2, 20, 32), f0(2, 20)
+    with torch.no_grad():
+        grouped = attn(x, xa=xa, en={"f0": pitch})[0]
+        repeated = attn(x, xa=xa.repeat_interleave(3, 0), en={"f0": pitch.repeat_interleave(3, 0)})[0]
+        plain = attn(x, xa=xa.repeat_interleave(3, 0))[0]
+    assert torch.allclose(grouped, repeated, atol=1e-5)
+    assert not torch.allclose(grouped, plain, atol=1e-3)
@@ -0,0 +1,45 @@
+import torch
+
+import model_b as mb
+
+from test_decoding import tiny
+
+
+def test_single_chunk_stream_matches_encode():
+    model = tiny()
+    x = torch.randn(1, 16, 40)
+    with torch.no_grad():
+        memories = list(model.stream_encode(x, chunk=64))
+        ref = model.encode({"spectrogram": x})
+    assert len(memories) == 1
+    assert torch.allclose(memories[0].xa, ref.xa, atol=1e-5)
+    for (k, v), (k0, v0) in zip(memories[0].kv, ref.kv):
+        assert torch.allclose(k, k0, atol=1e-5) and torch.allclose(v, v0, atol=1e-5)
+
+
+def test_front_end_and_cross_kv_match_across_chunk_boundaries():
+    model = tiny()
+    x = torch.randn(1, 16, 40)
+    stream = mb.StreamingEncoder(model.processor, chunk=8)
+    stream.blocks, stream.cache = [], []
+    memories = []
+    for piece in x.split([5, 11, 3, 9, 12], dim=-1):
+        memories += stream.push(piece)
+    memories += stream.push(None, final=True)
+    assert [m.xa.shape[1] for m in memories] == [8] * 5
+    with torch.no_grad():
+        front = stream.front(x, en={}, f="spectrogram", layer="enc")
+        kv = [block.attn.cross_kv(front, en={}, f="spectrogram", layer="cross") for block in model.processor.blockB]
+    assert torch.allclose(torch.cat([m.xa for m in memories], dim=1), front, atol=1e-5)
+    for i, (k, v) in enumerate(kv):
+        assert torch.allclose(torch.cat([m.kv[i][0] for m in memories], dim=2), k, atol=1e-5)
+        assert torch.allclose(torch.cat([m.kv[i][1] for m in memories], dim=2), v, atol=1e-5)
+
+
+def test_rope_offsets_past_the_table_match_the_cached_table():
+    rope = tiny().processor.blockB[0].attn.rope
+    with torch.no_grad():
+        cached = rope.cached_freqs(16, offset=56)
+        rope.max_table = 64
+        direct = rope.cached_freqs(16, offset=56)
+    assert torch.allclose(direct, cached, atol=1e-5)